@@ -1,8 +1,15 @@
 import os
 import sys
+import gzip
+import hashlib
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable, Iterator, Optional, Set, Tuple
 import google.auth
 import google.auth.transport.requests
 
@@ -10,9 +17,69 @@ import google.auth.transport.requests
 # Get the issue details from environment variables set by the GitHub Action
 ISSUE_TITLE = os.getenv("ISSUE_TITLE")
 ISSUE_BODY = os.getenv("ISSUE_BODY")
-GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID") # Get GCP Project ID from environment
-LLM_API_URL = f"https://us-central1-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}/locations/us-central1/publishers/google/models/gemini-1.5-flash:generateContent"
+# Setting GCP_PROJECT_ID selects the Vertex AI backend (authenticated via ADC);
+# otherwise the Generative Language API is used with GEMINI_API_KEY.
+GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+if GCP_PROJECT_ID:
+    LLM_API_URL = f"https://us-central1-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}/locations/us-central1/publishers/google/models/gemini-1.5-flash:streamGenerateContent?alt=sse"
+else:
+    LLM_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:streamGenerateContent?alt=sse"
 FILE_SEPARATOR = "---FILE_SEPARATOR---"
+TESTS_MARKER = "---TESTS_BEGIN---"
+_FILE_SEPARATOR_BYTES = FILE_SEPARATOR.encode('utf-8')
+_TESTS_MARKER_BYTES = TESTS_MARKER.encode('utf-8')
+# Set LLM_CACHE=1 to reuse responses for identical prompts (useful for local iteration and CI reruns)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE") == "1"
+LLM_CACHE_DIR = Path(".llm_cache")
+# (connect, read) timeouts in seconds for LLM API calls
+LLM_TIMEOUT = (10, 300)
+# Request bodies larger than this are sent gzip-compressed
+GZIP_REQUEST_MIN_BYTES = 8 * 1024
+
+# --- Prompt Template ---
+# The prompt is pre-built at import time; only the issue details are spliced in
+# at call time. Static instructions come first and the issue details last, so that
+# the prompt prefix is identical across runs and can hit the provider's prompt cache.
+_PROMPT_PREFIX = f"""
+    You are an expert Android developer and test engineer specializing in Kotlin and modern Android practices.
+    Your task is to generate all necessary files for a new feature, together with comprehensive unit tests for it, based on the GitHub issue given at the end of this prompt.
+
+    Instructions:
+    1.  Generate complete, production-ready Kotlin and XML layout files.
+    2.  Ensure the code is clean, well-commented, and follows standard Android architecture patterns (e.g., MVVM if applicable).
+    3.  After all application files, write a line containing only the exact marker '{TESTS_MARKER}', followed by the unit test files.
+    4.  Use JUnit 5 and Mockito for testing. Cover the logic in the generated code, including happy paths and edge cases.
+    5.  IMPORTANT: Your response MUST be a single block of text. Separate each file's content with the exact delimiter: '{FILE_SEPARATOR}'.
+    6.  At the beginning of each file's content, you MUST include a comment indicating its full, relative path from the project root. The format is critical. Example:
+        # FILE_PATH: app/src/main/java/com/example/myapp/MyNewActivity.kt
+        # FILE_PATH: app/src/test/java/com/example/myapp/MyNewActivityTest.kt
+    7.  For XML files, use a comment like this:
+        <!-- FILE_PATH: app/src/main/res/layout/activity_my_new.xml -->
+
+    ---DYNAMIC---
+    GitHub Issue Title: '"""
+_PROMPT_MID = """'
+    GitHub Issue Body:
+    ---
+    """
+_PROMPT_SUFFIX = """
+    ---
+    """
+
+# The response is parsed as UTF-8 bytes, so these patterns are bytes patterns.
+# Matches the file path comment (for both # and <!-- --> style comments)
+# (anchored at the end of the line so that the lazy path group captures the whole path)
+_FILE_PATH_RE = re.compile(rb"^\s*(?:#|<!--)\s*FILE_PATH:[ \t]*(.*?)[ \t]*(?:-->)?[ \t\r]*$", re.MULTILINE)
+# Match the opening and closing Markdown code fences of a block; either may be
+# missing (e.g. the FILE_PATH line sits inside the fence, or the response was cut off)
+_FENCE_OPEN_RE = re.compile(rb"\A\s*```[^\n]*\n")
+_FENCE_CLOSE_RE = re.compile(rb"\n?```\s*\Z")
+# Relative paths the agent is allowed to write to
+_VALID_PATH_RE = re.compile(r"^[A-Za-z0-9_./-]{1,256}$")
+# Path components the agent must never write into (compared case-insensitively):
+# git metadata (hooks, config) and the CI workflows that run this agent
+_PROTECTED_PATH_PARTS = frozenset({".git", ".github"})
 
 def get_gcp_auth_session():
     """
@@ -23,155 +90,321 @@ def get_gcp_auth_session():
         # This will automatically find the credentials provided by
         # the google-github-actions/auth action in the CI/CD environment.
         credentials, project_id = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+        # Fetch the access token up front so the LLM call does not pay for the
+        # OAuth refresh; the session reuses it until it expires.
+        credentials.refresh(google.auth.transport.requests.Request())
         authed_session = google.auth.transport.requests.AuthorizedSession(credentials)
         return authed_session
     except google.auth.exceptions.DefaultCredentialsError:
         print("Error: Could not find Google Cloud credentials.")
         print("Please ensure you are running in a configured GCP environment or have set up Application Default Credentials.")
         sys.exit(1)
+    except (google.auth.exceptions.RefreshError, google.auth.exceptions.TransportError) as e:
+        print(f"Error: Could not obtain a Google Cloud access token: {e}")
+        sys.exit(1)
+
+def _make_session() -> requests.Session:
+    """
+    Returns the session for the configured LLM backend.
 
-def call_llm(prompt: str, session: requests.Session) -> str:
+    The session is created once and shared by every LLM call, so all
+    requests reuse the same pooled keep-alive connection.
+    """
+    if GCP_PROJECT_ID:
+        session = get_gcp_auth_session()
+    else:
+        session = requests.Session()
+        session.headers['x-goog-api-key'] = GEMINI_API_KEY
+    # Retry transient API failures in-process over the same keep-alive connection
+    # rather than failing the whole CI job; the final error response is still
+    # surfaced by raise_for_status(). Read errors and timeouts are not retried:
+    # the request may already be generating, and each retry is billed in full.
+    retry = Retry(
+        total=5,
+        read=0,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=2, pool_maxsize=4))
+    return session
+
+def _cache_key(body: bytes) -> str:
     """
-    Calls the configured LLM API with a given prompt using an authenticated session.
+    Returns the on-disk cache key for a request.
+
+    The key covers the endpoint (and so the model) as well as the full serialized
+    request body, so a change to the prompt or generationConfig is a cache miss.
+    """
+    return hashlib.sha256(LLM_API_URL.encode('utf-8') + b"\n" + body).hexdigest()
+
+def call_llm(prompt: str, session: requests.Session) -> Iterator[str]:
+    """
+    Calls the configured LLM API with a given prompt using an authenticated session,
+    streaming the response back as it is generated.
+
+    When LLM_CACHE=1 is set, responses are cached on disk keyed by a SHA-256 hash
+    of the endpoint and request body, and a cached response is returned without
+    calling the API.
 
     Args:
         prompt: The prompt to send to the language model.
         session: The authenticated requests.Session object.
 
-    Returns:
-        The text content from the LLM's response.
+    Yields:
+        Chunks of the text content from the LLM's response, in order.
     """
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        # Deterministic, bounded, plain-text output keeps responses small and cacheable
+        "generationConfig": {
+            "temperature": 0.0,
+            "maxOutputTokens": 8192,
+            "responseMimeType": "text/plain",
+            "candidateCount": 1,
+        },
+    }
+    body = orjson.dumps(payload)
+
+    cache_path = LLM_CACHE_DIR / _cache_key(body)
+    if LLM_CACHE_ENABLED and cache_path.is_file():
+        print(f"Using cached LLM response from {cache_path}")
+        yield cache_path.read_text(encoding='utf-8')
+        return
+
     print("Sending prompt to LLM...")
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    headers = {'Content-Type': 'application/json'}
+    if len(body) > GZIP_REQUEST_MIN_BYTES:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    # Chunks are only kept for the cache; otherwise the response is never held in full
+    cached_chunks = []
+    received_text = False
+    chunk_data = None
+    error_body = None
+    finish_reason = None
 
     try:
-        response = session.post(LLM_API_URL, json=payload, timeout=300)
-        response.raise_for_status()
-        
-        response_data = response.json()
-        
-        candidates = response_data.get('candidates', [])
-        if not candidates:
-            raise ValueError("No candidates found in LLM response.")
-            
-        content = candidates[0].get('content', {})
-        parts = content.get('parts', [])
-        if not parts:
-            raise ValueError("No parts found in LLM response content.")
-
-        print("LLM response received successfully.")
-        return parts[0].get('text', '')
+        with session.post(LLM_API_URL, data=body, headers=headers, timeout=LLM_TIMEOUT, stream=True) as response:
+            if not response.ok:
+                # Read the error body now; it is no longer available once the response is closed
+                error_body = response.text
+            response.raise_for_status()
+
+            # Server-sent events: each "data:" line holds one partial response.
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                chunk_data = orjson.loads(line[len(b"data:"):])
+
+                candidates = chunk_data.get('candidates', [])
+                if not candidates:
+                    continue
+                finish_reason = candidates[0].get('finishReason', finish_reason)
+                for part in candidates[0].get('content', {}).get('parts', []):
+                    text = part.get('text', '')
+                    if text:
+                        received_text = True
+                        if LLM_CACHE_ENABLED:
+                            cached_chunks.append(text)
+                        yield text
+
+        if not received_text:
+            raise ValueError("No text found in LLM response.")
+        # Code and tests share one output budget, so truncation (MAX_TOKENS) or a
+        # SAFETY stop is possible; never treat a partial response as complete.
+        if finish_reason != "STOP":
+            raise ValueError(f"LLM response is incomplete (finishReason: {finish_reason}).")
 
     except requests.exceptions.RequestException as e:
         print(f"Error calling LLM API: {e}")
-        if e.response is not None:
-            print(f"Response Body: {e.response.text}")
+        if error_body is not None:
+            print(f"Response Body: {error_body}")
         sys.exit(1)
     except (KeyError, IndexError, ValueError) as e:
         print(f"Error parsing LLM response: {e}")
-        print(f"Full Response: {response_data}")
+        print(f"Last Response Chunk: {chunk_data}")
         sys.exit(1)
 
-def parse_and_write_files(response_text: str):
+    print("LLM response received successfully.")
+    if LLM_CACHE_ENABLED:
+        LLM_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text("".join(cached_chunks), encoding='utf-8')
+
+def _parse_block(block: bytes) -> Optional[Tuple[Path, bytes]]:
+    """
+    Extracts the target path and file content from a single file block.
+
+    Args:
+        block: The UTF-8 bytes of one file, starting with its FILE_PATH comment.
+
+    Returns:
+        A (path, content) tuple with the content still UTF-8 encoded, or None
+        if the block does not describe a file.
+    """
+    if not block.strip():
+        return None
+
+    match = _FILE_PATH_RE.search(block)
+    if not match:
+        print(f"Warning: Could not find FILE_PATH in block:\n---\n{block[:200].decode('utf-8', 'replace')}...\n---")
+        return None
+
+    file_path_str = match.group(1).strip().decode('utf-8', 'replace')
+    file_path = Path(file_path_str)
+    # Never let the LLM write outside the repository
+    if (
+        not _VALID_PATH_RE.match(file_path_str)
+        or file_path.is_absolute()
+        or ".." in file_path.parts
+        or any(part.lower() in _PROTECTED_PATH_PARTS for part in file_path.parts)
+    ):
+        print(f"Warning: Skipping block with invalid FILE_PATH '{file_path_str}'")
+        return None
+
+    content_start_index = match.end()
+    clean_block = block[content_start_index:]
+    clean_block = _FENCE_OPEN_RE.sub(b"", clean_block, count=1)
+    content = _FENCE_CLOSE_RE.sub(b"", clean_block, count=1).strip()
+
+    return file_path, content
+
+def _write_file(file_path: Path, data: bytes, made_dirs: Set[Path]) -> bool:
+    """
+    Writes content to a file, creating its parent directories as needed.
+
+    Files whose current content is already identical are left untouched, so
+    reruns do not dirty the working tree or invalidate Gradle's incremental build.
+
+    Args:
+        file_path: The path of the file to write.
+        data: The UTF-8 encoded content to write to the file.
+        made_dirs: Directories already created during this run; generated
+            files mostly share a few directories, so each is created only once.
+
+    Returns:
+        True if the file was written, False if it was already up to date.
+    """
+    try:
+        # The size check avoids reading files that obviously differ
+        if file_path.stat().st_size == len(data) and file_path.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+
+    parent = file_path.parent
+    if parent not in made_dirs:
+        parent.mkdir(parents=True, exist_ok=True)
+        made_dirs.add(parent)
+    # Write the bytes directly, bypassing the io text layer
+    remaining = memoryview(data)
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while remaining:
+            remaining = remaining[os.write(fd, remaining):]
+    finally:
+        os.close(fd)
+    return True
+
+def _iter_blocks(chunks: Iterable[bytes], separator: bytes) -> Iterator[bytes]:
+    """
+    Yields the separator-delimited blocks of a byte stream arriving in chunks.
+
+    Only the block currently being assembled is held in memory, and each
+    chunk is scanned once for the separator.
+
+    Args:
+        chunks: Consecutive chunks of the data to split.
+        separator: The delimiter between blocks.
+
+    Yields:
+        Each block, in order, including the final one after the last separator.
+    """
+    pending = b""
+    for chunk in chunks:
+        # A separator may straddle the previous chunk boundary
+        search_start = max(len(pending) - len(separator) + 1, 0)
+        pending += chunk
+        block_start = 0
+        while True:
+            separator_index = pending.find(separator, search_start)
+            if separator_index == -1:
+                break
+            yield pending[block_start:separator_index]
+            block_start = search_start = separator_index + len(separator)
+        pending = pending[block_start:]
+    yield pending
+
+def parse_and_write_files(response_chunks: Iterable[str]):
     """
     Parses the LLM response text, which contains multiple files,
     and writes each file to its specified path.
 
+    Files are written on a thread pool as soon as their block is complete,
+    so disk I/O overlaps with the rest of the response still being generated.
+
     Args:
-        response_text: The raw text from the LLM containing file blocks.
+        response_chunks: The raw text from the LLM containing file blocks,
+            as an iterable of consecutive chunks.
     """
     print("Parsing response and writing files...")
-    file_blocks = response_text.split(FILE_SEPARATOR)
-
-    for block in file_blocks:
-        if not block.strip():
-            continue
-
-        # Use regex to find the file path comment (for both # and <!-- --> style comments)
-        match = re.search(r"^\s*(?:#|<!--)\s*FILE_PATH:\s*(.*?)\s*(?:-->)?", block, re.MULTILINE)
-        if not match:
-            print(f"Warning: Could not find FILE_PATH in block:\n---\n{block[:200]}...\n---")
-            continue
-
-        file_path_str = match.group(1).strip()
-        
-        content_start_index = match.end()
-        clean_block = block[content_start_index:].strip()
-        if clean_block.startswith("```"):
-            first_line_end = clean_block.find('\n') + 1
-            clean_block = clean_block[first_line_end:]
-        if clean_block.endswith("```"):
-            clean_block = clean_block[:-3]
-        
-        content = clean_block.strip()
-
-        try:
-            file_path = Path(file_path_str)
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            file_path.write_text(content, encoding='utf-8')
+    # Work on UTF-8 bytes throughout; content is never decoded back to str
+    response_bytes = (chunk.encode('utf-8') for chunk in response_chunks)
+    writes = {}
+    made_dirs = set()
+    tests_marker_seen = False
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for separated_block in _iter_blocks(response_bytes, _FILE_SEPARATOR_BYTES):
+            # The tests marker is a file boundary too, and the first test file
+            # may follow it without a FILE_SEPARATOR
+            blocks = separated_block.split(_TESTS_MARKER_BYTES)
+            tests_marker_seen = tests_marker_seen or len(blocks) > 1
+            for block in blocks:
+                parsed = _parse_block(block)
+                if parsed is None:
+                    continue
+                file_path, content = parsed
+                previous_write = writes.get(file_path)
+                if previous_write is not None:
+                    # The same path was emitted twice: finish the earlier write first so
+                    # that the last block deterministically wins
+                    print(f"Warning: Duplicate FILE_PATH '{file_path}'; the later block replaces the earlier one")
+                    previous_write.exception()
+                writes[file_path] = executor.submit(_write_file, file_path, content, made_dirs)
+
+    for file_path, future in writes.items():
+        error = future.exception()
+        if error is not None:
+            print(f"Error writing file {file_path}: {error}")
+            sys.exit(1)
+        if future.result():
             print(f"Successfully wrote to {file_path}")
+        else:
+            print(f"Skipped {file_path}: content unchanged")
 
-        except Exception as e:
-            print(f"Error writing file {file_path_str}: {e}")
-            sys.exit(1)
+    if not tests_marker_seen:
+        print(f"Warning: Could not find '{TESTS_MARKER}' in LLM response; no unit tests were generated.")
 
 def main():
     """
     Main function to orchestrate the AI agent's tasks.
     """
-    if not ISSUE_TITLE or not ISSUE_BODY or not GCP_PROJECT_ID:
-        print("Error: ISSUE_TITLE, ISSUE_BODY, or GCP_PROJECT_ID environment variables not set.")
+    if not ISSUE_TITLE or not ISSUE_BODY or not (GCP_PROJECT_ID or GEMINI_API_KEY):
+        print("Error: ISSUE_TITLE, ISSUE_BODY, or one of GCP_PROJECT_ID/GEMINI_API_KEY environment variables not set.")
         sys.exit(1)
 
-    # Get an authenticated session for GCP
-    authed_session = get_gcp_auth_session()
-
-    # --- Step 1: Generate Application Code ---
-    print("\n--- Step 1: Generating Application Code ---")
-    code_gen_prompt = f"""
-    You are an expert Android developer specializing in Kotlin and modern Android practices.
-    Your task is to generate all necessary files for a new feature based on a GitHub issue.
+    # Get an authenticated session for the configured backend
+    authed_session = _make_session()
 
-    GitHub Issue Title: '{ISSUE_TITLE}'
-    GitHub Issue Body:
-    ---
-    {ISSUE_BODY}
-    ---
+    # --- Generate Application Code and Unit Tests ---
+    # Both are requested in a single call to save a full LLM round trip.
+    print("\n--- Generating Application Code and Unit Tests ---")
+    generation_prompt = _PROMPT_PREFIX + ISSUE_TITLE + _PROMPT_MID + ISSUE_BODY + _PROMPT_SUFFIX
 
-    Instructions:
-    1.  Generate complete, production-ready Kotlin and XML layout files.
-    2.  Ensure the code is clean, well-commented, and follows standard Android architecture patterns (e.g., MVVM if applicable).
-    3.  IMPORTANT: Your response MUST be a single block of text. Separate each file's content with the exact delimiter: '{FILE_SEPARATOR}'.
-    4.  At the beginning of each file's content, you MUST include a comment indicating its full, relative path from the project root. The format is critical. Example:
-        # FILE_PATH: app/src/main/java/com/example/myapp/MyNewActivity.kt
-    5.  For XML files, use a comment like this:
-        <!-- FILE_PATH: app/src/main/res/layout/activity_my_new.xml -->
-    """
-    
-    generated_code_response = call_llm(code_gen_prompt, authed_session)
-    parse_and_write_files(generated_code_response)
-    print("Application code generation complete.")
-
-    # --- Step 2: Generate Unit Tests ---
-    print("\n--- Step 2: Generating Unit Tests ---")
-    test_gen_prompt = f"""
-    You are an expert Android test engineer. Your task is to write comprehensive unit tests for the provided application code.
-
-    Application Code to Test:
-    ---
-    {generated_code_response}
-    ---
-
-    Instructions:
-    1.  Use JUnit 5 and Mockito for testing.
-    2.  Generate a complete test file that covers the logic in the provided code. Include tests for happy paths and edge cases.
-    3.  As before, your response must be a single block of text, and you MUST start the file content with a file path comment. Example:
-        # FILE_PATH: app/src/test/java/com/example/myapp/MyNewActivityTest.kt
-    """
-    
-    generated_test_response = call_llm(test_gen_prompt, authed_session)
-    parse_and_write_files(generated_test_response)
-    print("Unit test generation complete.")
+    parse_and_write_files(call_llm(generation_prompt, authed_session))
+    print("Application code and unit test generation complete.")
     print("\nAI Agent finished successfully.")
 
 if __name__ == "__main__":
@@ -259,7 +492,7 @@ jobs:
           python-version: '3.10'
 
       - name: Install Python dependencies
-        run: pip install requests google-auth
+        run: pip install requests google-auth orjson
 
       - name: Run AI Agent to Generate Code and Tests
         env: